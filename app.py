@@ -1,25 +1,51 @@
 import streamlit as st
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
 import os
 from datetime import datetime
 import pandas as pd
+import gzip
+import hashlib
 import json
+import math
+import re
+import tempfile
 import uuid
 import plotly.express as px
 from dotenv import load_dotenv
 from PIL import Image
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
 import io
-import base64
+from pathlib import Path
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import llm_cache
+import serialization
 
-# Load environment variables
-load_dotenv()
+# Load environment variables and configure Google Generative AI once per process.
+# No spinner: it would be the first Streamlit command, ahead of st.set_page_config
+@st.cache_resource(show_spinner=False)
+def init_genai():
+    load_dotenv()
+    api_key = os.getenv("GOOGLE_API_KEY")
+    if not api_key:
+        st.error("Missing GOOGLE_API_KEY. Add it to your .env file and restart the app.")
+        st.stop()
+    genai.configure(api_key=api_key)
+    return True
 
-# Configure Google Generative AI with API key
-try:
-    GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
-    genai.configure(api_key=GOOGLE_API_KEY)
-except Exception as e:
-    st.error(f"Error configuring Gemini API: {e}")
+init_genai()
+
+# Show raw model output for troubleshooting when APP_DEBUG=1
+DEBUG = os.getenv("APP_DEBUG") == "1"
+
+# Format of every stored timestamp; the Analytics page parses with it instead of letting pandas infer it
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Create each Gemini model once and reuse it across reruns
+@st.cache_resource(max_entries=100)
+def get_model(name="gemini-1.5-pro", system_instruction=None):
+    return genai.GenerativeModel(name, system_instruction=system_instruction)
 
 # Initialize session state variables if they don't exist
 if 'patient_records' not in st.session_state:
@@ -32,128 +58,250 @@ if 'patient_assessments' not in st.session_state:
     st.session_state.patient_assessments = {}   
 
 
-def generate_knowledge_assessment(patient_info):
-    """Generates a personalized quiz to assess patient knowledge of their condition."""
+# Matches the ```json code fence Gemini wraps around JSON responses
+JSON_FENCE_RE = re.compile(r"^\s*```(?:json)?\s*|\s*```\s*$", re.MULTILINE)
+
+# Builds the response cache key from everything sent to the model
+def response_cache_key(prompt, image=None, system_instruction=None):
+    parts = [prompt]
+    if system_instruction is not None:
+        parts.insert(0, system_instruction)
+    if image:
+        parts.append(image['data'])
+    return llm_cache.make_key(*parts)
+
+# Transient Gemini errors worth retrying; anything else (e.g. InvalidArgument) fails immediately
+RETRYABLE_ERRORS = (
+    google_exceptions.ResourceExhausted,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.DeadlineExceeded,
+    google_exceptions.InternalServerError,
+)
+
+# Sends contents to Gemini, retrying transient errors. A streamed request is retried until
+# its first chunk arrives, so text that has already been shown is never replayed
+@retry(
+    stop=stop_after_attempt(4),
+    wait=wait_exponential_jitter(initial=0.5, max=8),
+    retry=retry_if_exception_type(RETRYABLE_ERRORS),
+    reraise=True,
+)
+def send_to_gemini(model, contents, stream=False):
+    return model.generate_content(contents, stream=stream)
+
+# Sends a request to Gemini, streaming the text into placeholder and/or passing each
+# complete line to on_line as it arrives when either is given.
+# Worker threads pass in a model resolved on the script thread, as they can't use Streamlit caches
+def request_gemini(prompt, image=None, system_instruction=None, placeholder=None, on_line=None, model=None):
+    if model is None:
+        model = get_model(system_instruction=system_instruction)
+    contents = [prompt, image] if image else prompt
+    
+    if placeholder is None and on_line is None:
+        return send_to_gemini(model, contents).text
+    
+    response_text = ""
+    line_start = 0
+    for chunk in send_to_gemini(model, contents, stream=True):
+        response_text += chunk.text
+        if placeholder is not None:
+            placeholder.markdown(response_text)
+        if on_line is not None:
+            *lines, partial_line = response_text[line_start:].split("\n")
+            for line in lines:
+                on_line(line)
+            line_start = len(response_text) - len(partial_line)
+    
+    if on_line is not None:
+        on_line(response_text[line_start:])
+    return response_text
+
+# Function to call Gemini, reusing the stored response for an identical request
+def call_gemini(prompt, image=None, system_instruction=None, placeholder=None, on_line=None, model=None):
+    key = response_cache_key(prompt, image, system_instruction)
+    response_text = llm_cache.get(key)
+    
+    if response_text is None:
+        response_text = request_gemini(prompt, image, system_instruction, placeholder, on_line, model)
+        llm_cache.put(key, response_text)
+    else:
+        if placeholder is not None:
+            placeholder.markdown(response_text)
+        if on_line is not None:
+            for line in response_text.split("\n"):
+                on_line(line)
+    
+    return response_text
+
+# Fields every quiz question needs for display and evaluation
+QUESTION_FIELDS = ("text", "options", "correct_answer", "explanation")
+
+def is_question(value):
+    return isinstance(value, dict) and all(field in value for field in QUESTION_FIELDS)
+
+# Parses a single quiz question from one line of JSON, or returns None if the line isn't one
+def parse_question(line):
     try:
-        model = genai.GenerativeModel('gemini-1.5-pro')
-        
-        prompt = f"""
-        Create a knowledge assessment quiz for a patient with the following profile:
-        - Condition: {patient_info['condition']}
-        - Education Level: {patient_info['education_level']}
-        - Learning Style: {patient_info['learning_style']}
-        
-        Generate 5 multiple-choice questions that assess the patient's understanding of:
-        1. Basic condition information
-        2. Treatment rationale
-        3. Medication understanding
-        4. Self-management techniques
-        5. Warning signs requiring medical attention
-        
-        For each question, provide:
-        - The question text
-        - 4 possible answers (with one correct answer)
-        - An explanation of why the correct answer is right
-        - The knowledge category being tested
-        
-        Format the response as a valid JSON object with the following structure:
-        {{
-            "questions": [
-                {{
-                    "text": "Question text",
-                    "options": ["Option 1", "Option 2", "Option 3", "Option 4"],
-                    "correct_answer": "Correct option",
-                    "explanation": "Explanation of the correct answer",
-                    "category": "Category being tested"
-                }},
-                ...
-            ]
-        }}
-        """
-        
-        # Generate the response
-        response = model.generate_content(prompt)
-        
-        # Debug: Print the raw response
-        st.write("Raw API Response:", response.text)
-        
-        # Clean the response by removing triple backticks and the "json" keyword
-        cleaned_response = response.text.strip().replace("json", "").replace("", "").strip()
-        
-        # Parse JSON response
-        try:
-            assessment = json.loads(cleaned_response)
-            return assessment
-        except json.JSONDecodeError as e:
-            st.error(f"Failed to parse assessment: {e}")
-            st.error(f"Cleaned response: {cleaned_response}")
-            return {"error": "Failed to parse assessment", "raw_response": cleaned_response}
+        question = serialization.loads(line)
+    except json.JSONDecodeError:
+        return None
+    return question if is_question(question) else None
+
+def generate_knowledge_assessment(patient_info, on_question=None):
+    """Generates a personalized quiz, passing each question and its number to on_question as soon as Gemini has written it.
+    Returns None if the quiz could not be generated in full; questions already passed on should then be discarded."""
+    prompt = f"""
+    Create a knowledge assessment quiz for a patient with the following profile:
+    - Condition: {patient_info['condition']}
+    - Education Level: {patient_info['education_level']}
+    - Learning Style: {patient_info['learning_style']}
+    
+    Generate 5 multiple-choice questions that assess the patient's understanding of:
+    1. Basic condition information
+    2. Treatment rationale
+    3. Medication understanding
+    4. Self-management techniques
+    5. Warning signs requiring medical attention
+    
+    For each question, provide:
+    - The question text
+    - 4 possible answers (with one correct answer)
+    - An explanation of why the correct answer is right
+    - The knowledge category being tested
+    
+    Format the response as JSON Lines: one JSON object per question, each on a single line,
+    with no surrounding array, code fence or other text. Each object has this structure:
+    {{"text": "Question text", "options": ["Option 1", "Option 2", "Option 3", "Option 4"], "correct_answer": "Correct option", "explanation": "Explanation of the correct answer", "category": "Category being tested"}}
+    """
     
+    questions = []
+    
+    def handle_question(question):
+        questions.append(question)
+        if on_question is not None:
+            on_question(len(questions), question)
+    
+    def handle_line(line):
+        # Tolerate code fences and the brackets and commas of a JSON array around the objects
+        question = parse_question(JSON_FENCE_RE.sub("", line).strip().strip(",[]"))
+        if question is not None:
+            handle_question(question)
+    
+    try:
+        response_text = call_gemini(prompt, on_line=handle_line)
     except Exception as e:
+        # A stream that fails partway has only handed on some of the questions
         st.error(f"Error generating assessment: {e}")
-        return {"error": "Failed to generate assessment"}
+        return None
+    
+    if DEBUG:
+        st.expander("Raw API Response").code(response_text)
+    
+    # Gemini sometimes ignores the JSON Lines format, e.g. pretty-printing a list
+    # or a {"questions": [...]} object, so fall back to parsing the whole response
+    if not questions and response_text:
+        try:
+            assessment = serialization.loads(JSON_FENCE_RE.sub("", response_text).strip())
+        except json.JSONDecodeError:
+            assessment = []
+        if isinstance(assessment, dict):
+            assessment = assessment.get("questions", [])
+        
+        for question in assessment if isinstance(assessment, list) else []:
+            if is_question(question):
+                handle_question(question)
+        
+        if not questions:
+            st.error("Failed to parse assessment")
+    
+    # Don't keep serving a stored response that produced no usable questions
+    if not questions:
+        llm_cache.delete(response_cache_key(prompt))
+        return None
+    
+    return questions
     
     
 # Add this function to evaluate user responses
 def evaluate_responses(assessment, user_responses):
     """Evaluates user responses to the knowledge assessment."""
-    results = {
-        "total_questions": len(assessment["questions"]),
-        "correct_answers": 0,
-        "incorrect_answers": 0,
-        "feedback": []
-    }
-    
-    for i, question in enumerate(assessment["questions"]):
-        user_answer = user_responses.get(f"question_{i}")
-        if user_answer == question["correct_answer"]:
-            results["correct_answers"] += 1
+    questions = assessment["questions"]
+    total_questions = len(questions)
+    keys = [f"question_{i}" for i in range(total_questions)]
+    correct_answers = 0
+    feedback_list = [None] * total_questions
+    
+    for i, (question, key) in enumerate(zip(questions, keys)):
+        user_answer = user_responses.get(key)
+        correct_answer = question["correct_answer"]
+        if user_answer == correct_answer:
+            correct_answers += 1
             feedback = f"✅ Correct! {question['explanation']}"
         else:
-            results["incorrect_answers"] += 1
-            feedback = f"❌ Incorrect. The correct answer is: {question['correct_answer']}. {question['explanation']}"
+            feedback = f"❌ Incorrect. The correct answer is: {correct_answer}. {question['explanation']}"
         
-        results["feedback"].append({
+        feedback_list[i] = {
             "question": question["text"],
             "user_answer": user_answer,
-            "correct_answer": question["correct_answer"],
+            "correct_answer": correct_answer,
             "feedback": feedback
-        })
+        }
     
-    return results
+    return {
+        "total_questions": total_questions,
+        "correct_answers": correct_answers,
+        "incorrect_answers": total_questions - correct_answers,
+        "feedback": feedback_list
+    }
+
+# Injury analyses are memoized for an hour per image and description
+@st.cache_data(ttl=3600, show_spinner=False)
+def request_injury_analysis(image_hash, description, _image_part):
+    # Create a prompt with the image and description
+    prompt = f"""
+    Analyze this injury or skin condition based on the image and description:
+    
+    Patient Description: {description}
+    
+    Please provide the following:
+    1. Possible identification of the condition (disclaimer that this is not a medical diagnosis)
+    2. Common causes for this type of injury/condition
+    3. Recommended home remedies or over-the-counter treatments
+    4. When to seek professional medical attention
+    5. Precautions to follow
+    6. Expected healing timeline
+    
+    Format the response with clear headings and bullet points where appropriate.
+    Include a clear disclaimer at the beginning that this is not medical advice and serious conditions require professional medical attention.
+    """
+    
+    # Generate the content with both text and image input
+    return call_gemini(prompt, _image_part)
+
+# Longest side, in pixels, of images sent for injury analysis
+MAX_IMAGE_DIMENSION = 1024
+
+# Downscales large uploads to JPEG; smaller images keep their original bytes.
+# Only the most recent uploads are kept, since every entry holds a whole image
+@st.cache_data(ttl=3600, max_entries=20, show_spinner=False)
+def prepare_injury_image(file_id, _uploaded_file):
+    raw_bytes = _uploaded_file.getvalue()
+    image = Image.open(io.BytesIO(raw_bytes))
+    if max(image.size) <= MAX_IMAGE_DIMENSION:
+        return raw_bytes, _uploaded_file.type or 'image/jpeg'
+    
+    image.thumbnail((MAX_IMAGE_DIMENSION, MAX_IMAGE_DIMENSION), Image.LANCZOS)
+    buffered = io.BytesIO()
+    image.convert("RGB").save(buffered, format="JPEG", quality=85, optimize=True)
+    return buffered.getvalue(), 'image/jpeg'
 
 # Function to generate personalized patient education material
-def analyze_injury(image, description):
+def analyze_injury(image_bytes, description, mime_type='image/jpeg'):
     try:
-        model = genai.GenerativeModel('gemini-1.5-pro')
-        
-        # Convert the image to base64 for processing
-        buffered = io.BytesIO()
-        image.save(buffered, format="JPEG")
-        img_str = base64.b64encode(buffered.getvalue()).decode()
-        
-        # Create a prompt with the image and description
-        prompt = f"""
-        Analyze this injury or skin condition based on the image and description:
-        
-        Patient Description: {description}
-        
-        Please provide the following:
-        1. Possible identification of the condition (disclaimer that this is not a medical diagnosis)
-        2. Common causes for this type of injury/condition
-        3. Recommended home remedies or over-the-counter treatments
-        4. When to seek professional medical attention
-        5. Precautions to follow
-        6. Expected healing timeline
-        
-        Format the response with clear headings and bullet points where appropriate.
-        Include a clear disclaimer at the beginning that this is not medical advice and serious conditions require professional medical attention.
-        """
-        
-        # Generate the content with both text and image input
-        response = model.generate_content([prompt, {'mime_type': 'image/jpeg', 'data': img_str}])
-        
-        return response.text
+        # Generate the analysis, keyed on a hash of the image rather than its bytes
+        image_part = {'mime_type': mime_type, 'data': image_bytes}
+        image_hash = hashlib.sha1(image_bytes).hexdigest()
+        return request_injury_analysis(image_hash, description, image_part)
     
     except Exception as e:
         st.error(f"Error analyzing injury: {e}")
@@ -161,125 +309,314 @@ def analyze_injury(image, description):
 
 
 
-# Function to generate personalized patient education material
-def generate_patient_education(patient_info):
+# Function to build the education material prompt for a patient
+def build_education_prompt(patient_info):
+    return f"""
+    Generate personalized patient education material based on the following patient information:
+    
+    Patient Demographics:
+    - Age: {patient_info['age']}
+    - Gender: {patient_info['gender']}
+    - Education Level: {patient_info['education_level']}
+    - Primary Language: {patient_info['language']}
+    
+    Medical Information:
+    - Condition/Diagnosis: {patient_info['condition']}
+    - Treatment Plan: {patient_info['treatment']}
+    - Medication(s): {patient_info['medications']}
+    
+    Special Considerations:
+    - Learning Style: {patient_info['learning_style']}
+    - Special Needs: {patient_info['special_needs']}
+    
+    Create educational content that:
+    1. Explains their condition in simple, understandable terms appropriate for their education level
+    2. Describes their treatment plan and why it's important
+    3. Explains how to take their medications, potential side effects, and when to contact healthcare providers
+    4. Includes lifestyle recommendations specific to their condition
+    5. Uses language and examples appropriate for their age, gender, and cultural background
+    6. Adapts to their preferred learning style (visual, auditory, reading/writing, kinesthetic)
+    7. Accommodates any special needs mentioned
+    
+    The content should be empathetic, encouraging, and empowering for the patient.
+    Format the content with clear headings, bullet points where appropriate, and a summary at the end.
+    """
+
+# Identifies a material by its patient and content, so identical regenerations can be skipped
+def material_key(patient_id, content):
+    return (patient_id, hashlib.blake2b(content.encode(), digest_size=16).hexdigest())
+
+# Function to record a generated material for a patient, unless they already have the same content
+def record_material(patient_info, content):
+    key = material_key(patient_info["id"], content)
+    if key in st.session_state.material_hashes:
+        return
+    
+    material = {
+        "id": str(uuid.uuid4()),
+        "patient_id": patient_info["id"],
+        "patient_name": patient_info["name"],
+        "condition": patient_info["condition"],
+        "content": content,
+        "timestamp": datetime.now().strftime(TIMESTAMP_FORMAT)
+    }
+    
+    st.session_state.generated_materials.append(material)
+    st.session_state.material_hashes.add(key)
+    append_material(material)
+
+# Function to generate personalized patient education material; returns None if generation failed
+def generate_patient_education(patient_info, placeholder=None):
     try:
-        model = genai.GenerativeModel('gemini-1.5-pro')
-        
         # Construct prompt with patient information
-        prompt = f"""
-        Generate personalized patient education material based on the following patient information:
-        
-        Patient Demographics:
-        - Age: {patient_info['age']}
-        - Gender: {patient_info['gender']}
-        - Education Level: {patient_info['education_level']}
-        - Primary Language: {patient_info['language']}
-        
-        Medical Information:
-        - Condition/Diagnosis: {patient_info['condition']}
-        - Treatment Plan: {patient_info['treatment']}
-        - Medication(s): {patient_info['medications']}
-        
-        Special Considerations:
-        - Learning Style: {patient_info['learning_style']}
-        - Special Needs: {patient_info['special_needs']}
-        
-        Create educational content that:
-        1. Explains their condition in simple, understandable terms appropriate for their education level
-        2. Describes their treatment plan and why it's important
-        3. Explains how to take their medications, potential side effects, and when to contact healthcare providers
-        4. Includes lifestyle recommendations specific to their condition
-        5. Uses language and examples appropriate for their age, gender, and cultural background
-        6. Adapts to their preferred learning style (visual, auditory, reading/writing, kinesthetic)
-        7. Accommodates any special needs mentioned
-        
-        The content should be empathetic, encouraging, and empowering for the patient.
-        Format the content with clear headings, bullet points where appropriate, and a summary at the end.
-        """
+        prompt = build_education_prompt(patient_info)
         
-        response = model.generate_content(prompt)
+        content = call_gemini(prompt, placeholder=placeholder)
         
         # Record the generated material
-        material = {
-            "id": str(uuid.uuid4()),
-            "patient_id": patient_info["id"],
-            "patient_name": patient_info["name"],
-            "condition": patient_info["condition"],
-            "content": response.text,
-            "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        }
-        
-        st.session_state.generated_materials.append(material)
-        save_data()
+        record_material(patient_info, content)
         
-        return response.text
+        return content
     
     except Exception as e:
-        st.error(f"Error generating content: {e}")
-        return "Error generating content. Please check your Gemini API key and try again."
+        st.error(f"Error generating content: {e}. Please check your Gemini API key and try again.")
+        return None
+
+# Function to generate education material for several patients concurrently; failed patients get None
+def generate_many(patient_infos, status=None):
+    contents = [None] * len(patient_infos)
+    model = get_model()
+    
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        futures = {executor.submit(call_gemini, build_education_prompt(p), model=model): i for i, p in enumerate(patient_infos)}
+        
+        # Record each material as soon as its response arrives
+        for future in as_completed(futures):
+            patient_info = patient_infos[futures[future]]
+            try:
+                content = future.result()
+                record_material(patient_info, content)
+                if status is not None:
+                    status.write(f"Generated material for {patient_info['name']}")
+            except Exception as e:
+                st.error(f"Error generating content for {patient_info['name']}: {e}")
+                content = None
+            contents[futures[future]] = content
+    
+    return contents
+
+# Label shown for a patient in selection widgets
+def format_patient(patient):
+    return f"{patient['name']} - {patient['condition']}"
+
+# Builds the chat instructions for a patient, shared by every question they ask
+def build_chat_instruction(patient_info):
+    return f"""
+    You are a medical assistant chatbot helping a patient with their health condition.
+    
+    Patient Information:
+    - Name: {patient_info['name']}
+    - Age: {patient_info['age']}
+    - Gender: {patient_info['gender']}
+    - Education Level: {patient_info['education_level']}
+    - Primary Language: {patient_info['language']}
+    - Medical Condition: {patient_info['condition']}
+    - Treatment Plan: {patient_info['treatment']}
+    - Medications: {patient_info['medications']}
+    - Learning Style: {patient_info['learning_style']}
+    - Special Needs: {patient_info['special_needs']}
+    
+    For each question the patient asks, provide a single, clear, and concise answer that is:
+    1. Appropriate for their education level and learning style
+    2. Specific to their medical condition and treatment plan
+    3. Empathetic and reassuring
+    4. Accurate but not overly technical
+    5. Includes actionable advice when appropriate
+    
+    If the question is outside of your scope or requires immediate medical attention, advise the patient to contact their healthcare provider.
+    """
 
 # Function to handle patient chat interactions
-def chat_with_patient(patient_info, user_question):
+def chat_with_patient(patient_info, user_question, placeholder=None):
     try:
-        model = genai.GenerativeModel('gemini-1.5-pro')
-        
-        # Construct prompt with patient information and question
-        prompt = f"""
-        You are a medical assistant chatbot helping a patient with their health condition.
-        
-        Patient Information:
-        - Name: {patient_info['name']}
-        - Age: {patient_info['age']}
-        - Gender: {patient_info['gender']}
-        - Education Level: {patient_info['education_level']}
-        - Primary Language: {patient_info['language']}
-        - Medical Condition: {patient_info['condition']}
-        - Treatment Plan: {patient_info['treatment']}
-        - Medications: {patient_info['medications']}
-        - Learning Style: {patient_info['learning_style']}
-        - Special Needs: {patient_info['special_needs']}
+        # The patient profile goes in the system instruction so only the question varies
+        system_instruction = build_chat_instruction(patient_info)
+        prompt = f'The patient is asking: "{user_question}"'
         
-        The patient is asking: "{user_question}"
-        
-        Provide a single, clear, and concise answer that is:
-        1. Appropriate for their education level and learning style
-        2. Specific to their medical condition and treatment plan
-        3. Empathetic and reassuring
-        4. Accurate but not overly technical
-        5. Includes actionable advice when appropriate
-        
-        If the question is outside of your scope or requires immediate medical attention, advise the patient to contact their healthcare provider.
-        """
-        
-        response = model.generate_content(prompt)
-        return response.text
+        return call_gemini(prompt, system_instruction=system_instruction, placeholder=placeholder)
     
     except Exception as e:
         st.error(f"Error generating response: {e}")
         return "I'm sorry, I'm having trouble connecting to my knowledge base. Please try again later or contact your healthcare provider for assistance."
 
+# Data files, each holding JSON records, one per line. Only materials are gzip-compressed:
+# every append becomes its own gzip member, which only pays off for records as large as material content
+PATIENTS_FILE = "patients.jsonl"
+MATERIALS_FILE = "materials.jsonl.gz"
+CHATS_FILE = "chats.jsonl"
+INJURY_ASSESSMENTS_FILE = "injury_assessments.jsonl"
+LEGACY_DATA_FILE = "patient_education_data.json"
+
+# Favours speed over ratio; JSON still compresses well at this level
+COMPRESS_LEVEL = 3
+
+# Identifies a list of records by its length and last id, so cached helpers
+# can skip hashing the records themselves
+def records_signature(records):
+    return (len(records), records[-1]['id'] if records else "")
+
+# Counts distinct conditions, recomputed only when the records signature changes
+@st.cache_data(show_spinner=False)
+def count_unique_conditions(signature, _records):
+    return len({p['condition'] for p in _records})
+
+# Filter options and per-patient/per-condition material indices for the View Materials page.
+# Only indices are cached, since st.cache_data copies its return value on every hit
+@st.cache_data(show_spinner=False)
+def index_materials(signature, _materials):
+    by_patient = defaultdict(list)
+    by_condition = defaultdict(list)
+    for i, material in enumerate(_materials):
+        by_patient[material["patient_name"]].append(i)
+        by_condition[material["condition"]].append(i)
+    return sorted(by_patient), sorted(by_condition), dict(by_patient), dict(by_condition)
+
+# Material aggregations for the Analytics page. Only the aggregates are cached, since
+# st.cache_data copies its return value on every hit and the materials carry their full content
+@st.cache_data(show_spinner=False)
+def build_materials_analytics(signature, _materials):
+    materials_df = pd.DataFrame(_materials, columns=['patient_name', 'condition', 'timestamp'])
+    materials_df['date'] = pd.to_datetime(materials_df['timestamp'], format=TIMESTAMP_FORMAT).dt.date
+    
+    condition_counts = materials_df['condition'].value_counts().rename_axis('Condition').reset_index(name='Count')
+    patient_counts = materials_df['patient_name'].value_counts().rename_axis('Patient').reset_index(name='Count')
+    time_series = materials_df.groupby('date').size().reset_index(name='count')
+    
+    return condition_counts, patient_counts, time_series
+
+# Daily injury assessment counts for the Analytics page
+@st.cache_data(show_spinner=False)
+def build_injury_analytics(signature, _assessments):
+    injury_df = pd.DataFrame(_assessments, columns=['timestamp'])
+    injury_df['date'] = pd.to_datetime(injury_df['timestamp'], format=TIMESTAMP_FORMAT).dt.date
+    return injury_df.groupby('date').size().reset_index(name='count')
+
+# Opens a data file, through gzip when its name ends in .gz
+def open_records(path, mode):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode, compresslevel=COMPRESS_LEVEL)
+    return open(path, mode)
+
 # Functions to save and load data
+def append_record(path, record):
+    with open_records(path, "ab") as f:
+        f.write(serialization.dumps(record) + b"\n")
+
+def append_patient(patient):
+    append_record(PATIENTS_FILE, patient)
+
+def append_material(material):
+    append_record(MATERIALS_FILE, material)
+
+def append_chat(patient_id, message):
+    append_record(CHATS_FILE, {"patient_id": patient_id, **message})
+
+def append_injury_assessment(assessment):
+    append_record(INJURY_ASSESSMENTS_FILE, assessment)
+
+# Rewrites a data file through a temp file swapped in with os.replace,
+# so a crash mid-write leaves the previous file intact
+def write_records(path, records):
+    data = b"".join(serialization.dumps(record) + b"\n" for record in records)
+    if path.endswith(".gz"):
+        data = gzip.compress(data, compresslevel=COMPRESS_LEVEL)
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp", delete=False) as tmp:
+        tmp.write(data)
+    os.replace(tmp.name, path)
+
+def read_records(path):
+    if not os.path.exists(path):
+        return []
+    records = []
+    damaged = False
+    with open_records(path, "rb") as f:
+        try:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    records.append(serialization.loads(line))
+                except json.JSONDecodeError:
+                    damaged = True
+        except (EOFError, gzip.BadGzipFile):
+            damaged = True
+    
+    # A crash mid-append can leave a partial last record; rewrite the file without it
+    # so later appends don't land behind the damaged part
+    if damaged:
+        write_records(path, records)
+    return records
+
+# Flattens per-patient chat history into records for the chat log
+def chat_records(chat_history):
+    return [
+        {"patient_id": patient_id, **message}
+        for patient_id, messages in chat_history.items()
+        for message in messages
+    ]
+
+# Rewrites every data file from session state, compacting away deleted records
 def save_data():
-    data = {
-        "patients": st.session_state.patient_records,
-        "materials": st.session_state.generated_materials,
-        "chat_history": st.session_state.chat_history
+    write_records(PATIENTS_FILE, st.session_state.patient_records)
+    write_records(MATERIALS_FILE, st.session_state.generated_materials)
+    write_records(CHATS_FILE, chat_records(st.session_state.chat_history))
+    write_records(INJURY_ASSESSMENTS_FILE, st.session_state.injury_assessments)
+
+# Reads the data files once per process; every session shares the loaded records,
+# which are kept in step with the files by the append and save functions.
+# No spinner: it would be drawn before st.set_page_config
+@st.cache_resource(show_spinner=False)
+def load_store():
+    if not os.path.exists(PATIENTS_FILE) and os.path.exists(LEGACY_DATA_FILE):
+        # Migrate data saved by earlier versions as a single JSON file
+        with open(LEGACY_DATA_FILE, "rb") as f:
+            data = serialization.loads(f.read())
+        patients = data.get("patients", [])
+        materials = data.get("materials", [])
+        chat_history = data.get("chat_history", {})
+        write_records(PATIENTS_FILE, patients)
+        write_records(MATERIALS_FILE, materials)
+        write_records(CHATS_FILE, chat_records(chat_history))
+        injury_assessments = []
+    else:
+        patients = read_records(PATIENTS_FILE)
+        materials = read_records(MATERIALS_FILE)
+        chat_history = {}
+        for record in read_records(CHATS_FILE):
+            patient_id = record.pop("patient_id")
+            chat_history.setdefault(patient_id, []).append(record)
+        injury_assessments = read_records(INJURY_ASSESSMENTS_FILE)
+    
+    for patient in patients:
+        chat_history.setdefault(patient["id"], [])
+    
+    return {
+        "patients": patients,
+        "patients_by_id": {p["id"]: p for p in patients},
+        "materials": materials,
+        "material_hashes": {material_key(m["patient_id"], m["content"]) for m in materials},
+        "chat_history": chat_history,
+        "injury_assessments": injury_assessments,
     }
-    with open("patient_education_data.json", "w") as f:
-        json.dump(data, f)
 
 def load_data():
-    try:
-        with open("patient_education_data.json", "r") as f:
-            data = json.load(f)
-            st.session_state.patient_records = data.get("patients", [])
-            st.session_state.generated_materials = data.get("materials", [])
-            st.session_state.chat_history = data.get("chat_history", {})
-    except FileNotFoundError:
-        st.session_state.patient_records = []
-        st.session_state.generated_materials = []
-        st.session_state.chat_history = {}
+    store = load_store()
+    st.session_state.patient_records = store["patients"]
+    st.session_state.patients_by_id = store["patients_by_id"]
+    st.session_state.generated_materials = store["materials"]
+    st.session_state.material_hashes = store["material_hashes"]
+    st.session_state.chat_history = store["chat_history"]
+    st.session_state.injury_assessments = store["injury_assessments"]
 
 # Load existing data on app start
 load_data()
@@ -292,308 +629,16 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
-# Enhanced CSS with background image and improved styling
-st.markdown("""
-<style>
-body{
-    /* Base styles and background */
-    .main { 
-        background: linear-gradient(rgba(255, 255, 255, 0.6), rgba(255, 255, 255, 0.6)), 
-                    url('https://www.shutterstock.com/image-vector/medical-background-healthcare-technology-abstract-260nw-1687258565.jpg') center/cover fixed;
-        background-repeat: no-repeat;
-    }
-    
-    /* Adding an overlay to improve text readability over the background */
-    .main:before {
-        content: "";
-        position: fixed;
-        top: 0;
-        left: 0;
-        right: 0;
-        bottom: 0;
-        background: rgba(255, 255, 255, 0.4);
-        z-index: -1;
-    }
-    
-    .st-emotion-cache-16txtl3 {
-        padding: 3rem 1rem;
-    }
-    
-    /* Typography */
-    h1, h2, h3 {
-        color: #2c3e50;
-        font-weight: 600;
-    }
-    
-    /* Enhanced Glassmorphism card styles */
-    .glass-card {
-        background: rgba(255, 255, 255, 0.25);
-        backdrop-filter: blur(10px);
-        -webkit-backdrop-filter: blur(10px);
-        border-radius: 15px;
-        border: 1px solid rgba(255, 255, 255, 0.18);
-        box-shadow: 0 8px 32px 0 rgba(31, 38, 135, 0.15);
-        padding: 20px;
-        margin-bottom: 20px;
-        transition: all 0.3s ease;
-    }
-    
-    .glass-card:hover {
-        transform: translateY(-5px);
-        box-shadow: 0 15px 35px 0 rgba(31, 38, 135, 0.2);
-    }
-    
-    /* Improved Feature cards */
-    .feature-card {
-        # background: rgba(255, 255, 255, 0.3);
-        backdrop-filter: blur(7px);
-        -webkit-backdrop-filter: blur(7px);
-        border-radius: 15px;
-        padding: 18px;
-        border-left: 5px solid rgba(52, 152, 219, 0.8);
-        margin-bottom: 20px;
-        transition: all 0.3s ease;
-        height: 100%;
-    }
-    
-    .feature-card:hover {
-        transform: translateY(-5px);
-        background: rgba(255, 255, 255, 0.4);
-        box-shadow: 0 10px 25px rgba(0, 0, 0, 0.1);
-    }
-    
-    .feature-card h3 {
-        margin-top: 0;
-        font-size: 1.3rem;
-    }
-    
-    .feature-card p {
-        margin-bottom: 0;
-        line-height: 1.5;
-    }
-    
-    /* Enhanced Hero section */
-    .hero-section {
-        background: linear-gradient(135deg, rgba(52, 152, 219, 0.8), rgba(155, 89, 182, 0.8));
-        background: linear-gradient(rgba(0, 0, 0, 0.6), rgba(0, 0, 0, 0.6)),
-        url('https://images.unsplash.com/photo-1576091160550-2173dba999ef?auto=format&fit=crop&q=80') center/cover fixed;
-        backdrop-filter: blur(10px);
-        -webkit-backdrop-filter: blur(10px);
-        border-radius: 20px;
-        border: 1px solid rgba(255, 255, 255, 0.18);
-        box-shadow: 0 8px 32px 0 rgba(31, 38, 135, 0.2);
-        padding: 50px 40px;
-        color: white;
-        margin-bottom: 40px;
-        text-align: center;
-        position: relative;
-        overflow: hidden;
-        height: 80vh;
-        display: flex;
-        justify-content: center;
-        align-items: center;
-    }
-    
-    .hero-section:before {
-        content: "";
-        position: absolute;
-        top: -20px;
-        right: -20px;
-        width: 140px;
-        height: 140px;
-        background: rgba(255, 255, 255, 0.1);
-        border-radius: 50%;
-    }
-    
-    .hero-section:after {
-        content: "";
-        position: absolute;
-        bottom: -30px;
-        left: -30px;
-        width: 180px;
-        height: 180px;
-        background: rgba(255, 255, 255, 0.05);
-        border-radius: 50%;
-    }
-    
-    .hero-section h1 {
-        font-size: 3rem;
-        margin-bottom: 15px;
-        color: white;
-        text-shadow: 0 2px 5px rgba(0, 0, 0, 0.2);
-    }
-    
-    .hero-section p {
-        font-size: 1.3rem;
-        max-width: 800px;
-        margin: 0 auto;
-        opacity: 0.9;
-    }
-    
-    /* Enhanced Sidebar navigation */
-    .css-1d391kg, .css-hxt7ib {
-        background: rgba(245, 247, 250, 0.85) !important;
-        backdrop-filter: blur(15px) !important;
-        -webkit-backdrop-filter: blur(15px) !important;
-        border-right: 1px solid rgba(230, 230, 230, 0.7);
-        
-    }
-    
-    .css-1v3fvcr {
-        overflow-x: hidden;
-    }
-    
-    /* Custom Navigation Menu */
-    .nav-item {
-        display: flex;
-        align-items: center;
-        padding: 10px 15px;
-        border-radius: 10px;
-        margin-bottom: 8px;
-        cursor: pointer;
-        transition: all 0.2s ease;
-        background: rgba(255, 255, 255, 0.5);
-        
-    }
-    
-    .nav-item:hover, .nav-item.active {
-        background: rgba(52, 152, 219, 0.2);
-    }
-    
-    .nav-icon {
-        margin-right: 10px;
-        font-size: 1.2rem;
-        color: #3498db;
-    }
-    
-    /* Dashboard stats cards */
-    .stats-card {
-        background: rgba(255, 255, 255, 0.3);
-        background: linear-gradient(rgba(0, 0, 0, 0.8), rgba(0, 0, 0, 0.8)),
-                url('https://images.unsplash.com/photo-1505751172876-fa1923c5c528') center/cover fixed;
-        backdrop-filter: blur(7px);
-        -webkit-backdrop-filter: blur(7px);
-        border-radius: 15px;
-        padding: 25px;
-        text-align: center;
-        border: 1px solid rgba(255, 255, 255, 0.18);
-        box-shadow: 0 8px 32px 0 rgba(31, 38, 135, 0.1);
-        transition: all 0.3s ease;
-        height: 100%;
-    }
-    
-    .stats-card:hover {
-        transform: translateY(-5px);
-        box-shadow: 0 12px 25px rgba(0, 0, 0, 0.1);
-    }
-    
-    .metric-number {
-        font-size: 2.8rem;
-        font-weight: bold;
-        color: #3498db;
-        margin-bottom: 5px;
-        text-shadow: 0 2px 5px rgba(0, 0, 0, 0.1);
-    }
-    
-    .metric-label {
-        font-size: 1rem;
-        color: #7f8c8d;
-        text-transform: uppercase;
-        letter-spacing: 1px;
-    }
-    
-    /* Quick Start Guide */
-    .guide-card {
-        # background: rgba(255, 255, 255, 0.25);
-           background: linear-gradient(rgba(0, 0, 0, 0.8), rgba(0, 0, 0, 0.8)),
-                url('https://images.unsplash.com/photo-1505751172876-fa1923c5c528') center/cover fixed;
-        backdrop-filter: blur(7px);
-        -webkit-backdrop-filter: blur(7px);
-        border-radius: 15px;
-        padding: 25px;
-        border: 1px solid rgba(255, 255, 255, 0.18);
-        box-shadow: 0 8px 32px 0 rgba(31, 38, 135, 0.1);
-        height: 100%;
-    }
-    
-    .guide-card h3 {
-        color: #3498db;
-        margin-top: 0;
-        font-size: 1.5rem;
-        margin-bottom: 15px;
-        border-bottom: 2px solid rgba(52, 152, 219, 0.3);
-        padding-bottom: 10px;
-    }
-    
-    .guide-card ol, .guide-card ul {
-        padding-left: 20px;
-    }
-    
-    .guide-card li {
-        margin-bottom: 15px;
-        line-height: 1.5;
-    }
-    
-    /* Animation keyframes */
-    @keyframes slideInUp {
-        from { opacity: 0; transform: translateY(30px); }
-        to { opacity: 1; transform: translateY(0); }
-    }
-    
-    @keyframes fadeIn {
-        from { opacity: 0; }
-        to { opacity: 1; }
-    }
-    
-    /* Apply animations to elements */
-    .hero-section {
-        animation: fadeIn 0.8s ease-out forwards;
-    }
-    
-    .feature-card, .stats-card, .guide-card {
-        animation: slideInUp 0.6s ease-out forwards;
-    }
-    
-    /* Staggered animations for feature cards */
-    .feature-card:nth-child(1) { animation-delay: 0.1s; }
-    .feature-card:nth-child(2) { animation-delay: 0.2s; }
-    .feature-card:nth-child(3) { animation-delay: 0.3s; }
-    
-    /* Footer */
-    .footer {
-        text-align: center;
-        padding: 20px;
-        margin-top: 40px;
-        color: #7f8c8d;
-        font-size: 0.9rem;
-        border-top: 1px solid rgba(0, 0, 0, 0.05);
-    }
-    
-    .chat-message {
-        padding: 15px;
-        border-radius: 15px;
-        margin-bottom: 10px;
-        display: flex;
-        flex-direction: column;
-        max-width: 80%;
-    }
-    .user-message {
-        background-color: #3498db;
-        color: white;
-        border-bottom-right-radius: 5px;
-        align-self: flex-end;
-        margin-left: auto;
-    }
-    .bot-message {
-        background-color: #f1f1f1;
-        color: #333;
-        border-bottom-left-radius: 5px;
-        align-self: flex-start;
-        margin-right: auto;
-    }
-    
-</style>
-""", unsafe_allow_html=True)
+# Enhanced CSS with background image and improved styling, read and minified once.
+# Streamlit drops any element a rerun doesn't draw again, so the style tag is still sent every rerun
+@st.cache_data(show_spinner=False)
+def load_css():
+    css = (Path(__file__).parent / "static" / "style.css").read_text()
+    css = re.sub(r"/\*.*?\*/", "", css, flags=re.DOTALL)
+    css = re.sub(r"\s+", " ", css)
+    return re.sub(r"\s*([{};,])\s*", r"\1", css).strip()
+
+st.markdown(f"<style>{load_css()}</style>", unsafe_allow_html=True)
 
 # Hidden radio button for navigation (controlled by the custom nav)
 page = st.sidebar.radio("Navigation", ["Home", "Add Patient", "Generate Materials", "Patient Chat", "View Materials", "Analytics", "Injury Assessment" , "Knowledge Assessment"], label_visibility="collapsed")
@@ -608,26 +653,120 @@ def nav_item(title, icon, page_name, current_page):
     </div>
     """
 
-# # Create the navigation HTML
-nav_item = f"""
-{nav_item("Home", "🏠", "Home", page)}
-{nav_item("Add Patient", "👤", "Add Patient", page)}
-{nav_item("Generate Materials", "📚", "Generate Materials", page)}
-{nav_item("Patient Chat", "💬", "Patient Chat", page)}
-{nav_item("View Materials", "📋", "View Materials", page)}
-{nav_item("Analytics", "📊", "Analytics", page)}
-{nav_item("Injury Assessment", "🤕", "Injury Assessment", page)}
-{nav_item("Knowledge Assessment", "🤔", "Knowledge Assessment", page)}
+# Create the navigation HTML once per page
+@st.cache_data(show_spinner=False)
+def render_nav_html(current_page):
+    return f"""
+{nav_item("Home", "🏠", "Home", current_page)}
+{nav_item("Add Patient", "👤", "Add Patient", current_page)}
+{nav_item("Generate Materials", "📚", "Generate Materials", current_page)}
+{nav_item("Patient Chat", "💬", "Patient Chat", current_page)}
+{nav_item("View Materials", "📋", "View Materials", current_page)}
+{nav_item("Analytics", "📊", "Analytics", current_page)}
+{nav_item("Injury Assessment", "🤕", "Injury Assessment", current_page)}
+{nav_item("Knowledge Assessment", "🤔", "Knowledge Assessment", current_page)}
 """
 
 # Display the custom navigation
-st.sidebar.markdown(nav_item, unsafe_allow_html=True)
+st.sidebar.markdown(render_nav_html(page), unsafe_allow_html=True)
+
+# Option to clear stored Gemini responses
+if st.sidebar.button("Clear Cache"):
+    llm_cache.clear()
+    request_injury_analysis.clear()
+    st.sidebar.success("Response cache cleared!")
 
 # Sidebar footer (fixed at the bottom)
 st.sidebar.markdown("""
 
 """, unsafe_allow_html=True)
 
+# Patient selectbox shared by the patient pages; returns the chosen patient record itself,
+# so patients sharing a "Name - Condition" label can still be told apart
+def select_patient():
+    patient_options = list(st.session_state.patients_by_id.values())
+    return st.selectbox("Select Patient", patient_options, format_func=format_patient)
+
+# Patient information expander, one markdown block per column
+def render_patient_info(patient, expanded=True):
+    with st.expander("Patient Information", expanded=expanded):
+        col1, col2 = st.columns(2)
+        col1.markdown("\n\n".join([
+            f"Name: {patient['name']}",
+            f"Age: {patient['age']}",
+            f"Gender: {patient['gender']}",
+            f"Education Level: {patient['education_level']}",
+            f"Primary Language: {patient['language']}",
+        ]))
+        col2.markdown("\n\n".join([
+            f"Medical Condition: {patient['condition']}",
+            f"Treatment Plan: {patient['treatment']}",
+            f"Medications: {patient['medications']}",
+            f"Learning Style: {patient['learning_style']}",
+            f"Special Needs: {patient['special_needs']}",
+        ]))
+
+# Chat display and input, rerun on its own so sending a message skips the rest of the page
+@st.fragment
+def chat_fragment(patient):
+    patient_id = patient['id']
+    
+    # Chat container
+    st.markdown(f"### Chat with {patient['name']}'s Personal Health Assistant")
+    st.markdown("Ask questions about your condition, treatment, medications, or health concerns.")
+    
+    # Messages go in a container above the input, including ones added this run
+    chat_container = st.container()
+    
+    # Display welcome message if chat is empty
+    if not st.session_state.chat_history[patient_id]:
+        with chat_container.chat_message("assistant"):
+            st.markdown(
+                f"Hello {patient['name']}! I'm your personal health assistant. "
+                f"I know about your {patient['condition']} and can answer questions about your treatment plan "
+                f"or medications. How can I help you today?"
+            )
+    
+    # Display chat history
+    for message in st.session_state.chat_history[patient_id]:
+        with chat_container.chat_message(message["role"]):
+            st.markdown(message["content"])
+    
+    # Chat input
+    if user_question := st.chat_input("Type your health question here:"):
+        # Add user message to chat history
+        user_message = {
+            "role": "user",
+            "content": user_question,
+            "timestamp": datetime.now().strftime(TIMESTAMP_FORMAT)
+        }
+        st.session_state.chat_history[patient_id].append(user_message)
+        append_chat(patient_id, user_message)
+        
+        with chat_container.chat_message("user"):
+            st.markdown(user_question)
+        
+        # Generate response, streaming it into a new assistant message
+        with chat_container.chat_message("assistant"):
+            with st.spinner("Thinking..."):
+                bot_response = chat_with_patient(patient, user_question, placeholder=st.empty())
+        
+        # Add bot response to chat history
+        bot_message = {
+            "role": "assistant",
+            "content": bot_response,
+            "timestamp": datetime.now().strftime(TIMESTAMP_FORMAT)
+        }
+        st.session_state.chat_history[patient_id].append(bot_message)
+        append_chat(patient_id, bot_message)
+    
+    # Option to clear chat history
+    if st.button("Clear Chat History"):
+        st.session_state.chat_history[patient_id] = []
+        write_records(CHATS_FILE, chat_records(st.session_state.chat_history))
+        st.success("Chat history cleared!")
+        st.rerun(scope="fragment")
+
 # Home page with enhanced design
 
 if page == "Home":
@@ -663,10 +802,8 @@ if page == "Home":
     
     with col_c:
         # Calculate unique conditions
-        if st.session_state.patient_records:
-            unique_conditions = len(set(p['condition'] for p in st.session_state.patient_records))
-        else:
-            unique_conditions = 0
+        records = st.session_state.patient_records
+        unique_conditions = count_unique_conditions(records_signature(records), records)
             
         st.markdown(f"""
         <div class="stats-card">
@@ -804,13 +941,14 @@ elif page == "Add Patient":
                     "medications": medications,
                     "learning_style": learning_style,
                     "special_needs": special_needs,
-                    "date_added": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                    "date_added": datetime.now().strftime(TIMESTAMP_FORMAT)
                 }
                 
                 st.session_state.patient_records.append(patient)
+                st.session_state.patients_by_id[patient_id] = patient
                 # Initialize chat history for this patient
                 st.session_state.chat_history[patient_id] = []
-                save_data()
+                append_patient(patient)
                 
                 st.success(f"Patient {name} added successfully!")
                 st.balloons()
@@ -825,41 +963,23 @@ elif page == "Generate Materials":
         st.warning("No patients found. Please add patients first.")
     else:
         # Patient selection
-        patient_names = [f"{p['name']} - {p['condition']}" for p in st.session_state.patient_records]
-        selected_patient = st.selectbox("Select Patient", patient_names)
-        
-        # Get the selected patient's index
-        patient_index = patient_names.index(selected_patient)
-        patient = st.session_state.patient_records[patient_index]
+        patient = select_patient()
         
         # Display patient information
-        with st.expander("Patient Information", expanded=True):
-            col1, col2 = st.columns(2)
-            
-            with col1:
-                st.markdown(f"Name: {patient['name']}")
-                st.markdown(f"Age: {patient['age']}")
-                st.markdown(f"Gender: {patient['gender']}")
-                st.markdown(f"Education Level: {patient['education_level']}")
-                st.markdown(f"Primary Language: {patient['language']}")
-            
-            with col2:
-                st.markdown(f"Medical Condition: {patient['condition']}")
-                st.markdown(f"Treatment Plan: {patient['treatment']}")
-                st.markdown(f"Medications: {patient['medications']}")
-                st.markdown(f"Learning Style: {patient['learning_style']}")
-                st.markdown(f"Special Needs: {patient['special_needs']}")
+        render_patient_info(patient, expanded=True)
         
         # Generate content
         if st.button("Generate Personalized Education Material"):
-            with st.spinner("Generating personalized content..."):
-                content = generate_patient_education(patient)
-                
-                st.success("Material generated successfully!")
-                
-                # Display the generated content
-                st.markdown("### Generated Education Material")
-                st.markdown(content)
+            status = st.status("Generating personalized content...")
+            
+            # Display the generated content as it streams in
+            st.markdown("### Generated Education Material")
+            content = generate_patient_education(patient, placeholder=st.empty())
+            
+            if content is None:
+                status.update(label="Material generation failed", state="error")
+            else:
+                status.update(label="Material generated successfully!", state="complete")
                 
                 # Download option
                 st.download_button(
@@ -868,6 +988,26 @@ elif page == "Generate Materials":
                     file_name=f"{patient['name']}_{patient['condition']}_education.txt",
                     mime="text/plain"
                 )
+        
+        # Generate content for several patients at once
+        st.markdown("### Generate for Multiple Patients")
+        patient_options = list(st.session_state.patients_by_id.values())
+        batch_patients = st.multiselect("Select Patients", patient_options, format_func=format_patient)
+        
+        if st.button("Generate for Selected Patients") and batch_patients:
+            with st.status("Generating personalized content...", expanded=True) as status:
+                contents = generate_many(batch_patients, status)
+                generated_count = sum(content is not None for content in contents)
+                if generated_count == len(contents):
+                    status.update(label=f"Generated {generated_count} materials successfully!", state="complete", expanded=False)
+                else:
+                    status.update(label=f"Generated {generated_count} of {len(contents)} materials", state="error")
+            
+            for batch_patient, content in zip(batch_patients, contents):
+                if content is None:
+                    continue
+                with st.expander(f"{batch_patient['name']} - {batch_patient['condition']}"):
+                    st.markdown(content)
 
 # New Patient Chat page
 elif page == "Patient Chat":
@@ -877,109 +1017,17 @@ elif page == "Patient Chat":
         st.warning("No patients found. Please add patients first.")
     else:
         # Patient selection
-        patient_names = [f"{p['name']} - {p['condition']}" for p in st.session_state.patient_records]
-        selected_patient = st.selectbox("Select Patient", patient_names)
-        
-        # Get the selected patient's index and information
-        patient_index = patient_names.index(selected_patient)
-        patient = st.session_state.patient_records[patient_index]
+        patient = select_patient()
         patient_id = patient['id']
         
         # Display patient information
-        with st.expander("Patient Information", expanded=False):
-            col1, col2 = st.columns(2)
-            
-            with col1:
-                st.markdown(f"Name: {patient['name']}")
-                st.markdown(f"Age: {patient['age']}")
-                st.markdown(f"Gender: {patient['gender']}")
-                st.markdown(f"Education Level: {patient['education_level']}")
-                st.markdown(f"Primary Language: {patient['language']}")
-            
-            with col2:
-                st.markdown(f"Medical Condition: {patient['condition']}")
-                st.markdown(f"Treatment Plan: {patient['treatment']}")
-                st.markdown(f"Medications: {patient['medications']}")
-                st.markdown(f"Learning Style: {patient['learning_style']}")
-                st.markdown(f"Special Needs: {patient['special_needs']}")
+        render_patient_info(patient, expanded=False)
         
         # Initialize chat history for this patient if it doesn't exist
         if patient_id not in st.session_state.chat_history:
             st.session_state.chat_history[patient_id] = []
         
-        # Chat container
-        st.markdown(f"### Chat with {patient['name']}'s Personal Health Assistant")
-        st.markdown("Ask questions about your condition, treatment, medications, or health concerns.")
-        
-        # Display chat history
-        chat_container = st.container()
-        with chat_container:
-            st.markdown('<div class="message-container">', unsafe_allow_html=True)
-            
-            # Display welcome message if chat is empty
-            if not st.session_state.chat_history[patient_id]:
-                st.markdown(
-                    f'<div class="chat-message bot-message">'
-                    f'<p>Hello {patient["name"]}! I\'m your personal health assistant. '
-                    f'I know about your {patient["condition"]} and can answer questions about your treatment plan '
-                    f'or medications. How can I help you today?</p>'
-                    f'</div>',
-                    unsafe_allow_html=True
-                )
-            
-            # Display chat history
-            for message in st.session_state.chat_history[patient_id]:
-                if message["role"] == "user":
-                    st.markdown(
-                        f'<div class="chat-message user-message">'
-                        f'<p>{message["content"]}</p>'
-                        f'</div>',
-                        unsafe_allow_html=True
-                    )
-                else:
-                    st.markdown(
-                        f'<div class="chat-message bot-message">'
-                        f'<p>{message["content"]}</p>'
-                        f'</div>',
-                        unsafe_allow_html=True
-                    )
-            
-            st.markdown('</div>', unsafe_allow_html=True)
-        
-        # Chat input
-        user_question = st.text_input("Type your health question here:", key="user_question")
-        
-        if st.button("Send") and user_question:
-            # Add user message to chat history
-            st.session_state.chat_history[patient_id].append({
-                "role": "user",
-                "content": user_question,
-                "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            })
-            
-            # Generate response
-            with st.spinner("Thinking..."):
-                bot_response = chat_with_patient(patient, user_question)
-            
-            # Add bot response to chat history
-            st.session_state.chat_history[patient_id].append({
-                "role": "assistant",
-                "content": bot_response,
-                "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            })
-            
-            # Save chat history
-            save_data()
-            
-            # Rerun to display the new messages
-            st.rerun()
-        
-        # Option to clear chat history
-        if st.button("Clear Chat History"):
-            st.session_state.chat_history[patient_id] = []
-            save_data()
-            st.success("Chat history cleared!")
-            st.rerun()
+        chat_fragment(patient)
 
 # View Materials page
 elif page == "View Materials":
@@ -988,32 +1036,49 @@ elif page == "View Materials":
     if not st.session_state.generated_materials:
         st.warning("No educational materials have been generated yet.")
     else:
+        materials = st.session_state.generated_materials
+        patient_names, conditions, by_patient, by_condition = index_materials(records_signature(materials), materials)
+        
         # Filter options
         col1, col2 = st.columns(2)
         with col1:
-            filter_patient = st.selectbox(
-                "Filter by Patient", 
-                ["All"] + list(set(material["patient_name"] for material in st.session_state.generated_materials))
-            )
+            filter_patient = st.selectbox("Filter by Patient", ["All"] + patient_names)
         with col2:
-            filter_condition = st.selectbox(
-                "Filter by Condition", 
-                ["All"] + list(set(material["condition"] for material in st.session_state.generated_materials))
-            )
+            filter_condition = st.selectbox("Filter by Condition", ["All"] + conditions)
         
         # Apply filters
-        filtered_materials = st.session_state.generated_materials
-        if filter_patient != "All":
-            filtered_materials = [m for m in filtered_materials if m["patient_name"] == filter_patient]
-        if filter_condition != "All":
-            filtered_materials = [m for m in filtered_materials if m["condition"] == filter_condition]
+        if filter_patient != "All" and filter_condition != "All":
+            filtered_materials = [materials[i] for i in by_patient[filter_patient] if materials[i]["condition"] == filter_condition]
+        elif filter_patient != "All":
+            filtered_materials = [materials[i] for i in by_patient[filter_patient]]
+        elif filter_condition != "All":
+            filtered_materials = [materials[i] for i in by_condition[filter_condition]]
+        else:
+            filtered_materials = materials
         
         # Display materials
         if not filtered_materials:
             st.info("No materials match the selected filters.")
         else:
-            for material in filtered_materials:
-                with st.expander(f"{material['patient_name']} - {material['condition']} ({material['timestamp']})"):
+            # Show the materials a page at a time so long histories don't all render at once
+            page_size = 20
+            total_pages = max(1, math.ceil(len(filtered_materials) / page_size))
+            if st.session_state.get("materials_page", 1) > total_pages:
+                st.session_state.materials_page = total_pages
+            materials_page = st.number_input("Page", min_value=1, max_value=total_pages, key="materials_page")
+            st.caption(f"Page {materials_page} of {total_pages} ({len(filtered_materials)} materials)")
+            page_materials = filtered_materials[(materials_page - 1) * page_size : materials_page * page_size]
+            
+            for material in page_materials:
+                with st.container(border=True):
+                    # The content is only sent to the browser while its toggle is on, unlike a collapsed expander
+                    is_open = st.toggle(
+                        f"{material['patient_name']} - {material['condition']} ({material['timestamp']})",
+                        key=f"expanded_{material['id']}"
+                    )
+                    if not is_open:
+                        continue
+                    
                     st.markdown(material["content"])
                     
                     col1, col2 = st.columns(2)
@@ -1028,6 +1093,7 @@ elif page == "View Materials":
                     with col2:
                         if st.button("Delete", key=f"delete_{material['id']}"):
                             st.session_state.generated_materials.remove(material)
+                            st.session_state.material_hashes.discard(material_key(material["patient_id"], material["content"]))
                             save_data()
                             st.success("Material deleted")
                             st.rerun()
@@ -1050,8 +1116,8 @@ elif page == "Injury Assessment":
     with col1:
         uploaded_file = st.file_uploader("Upload image of injury/condition", type=["jpg", "jpeg", "png"])
         if uploaded_file is not None:
-            image = Image.open(uploaded_file)
-            st.image(image, caption="Uploaded Image", use_column_width=True)
+            image_bytes, mime_type = prepare_injury_image(uploaded_file.file_id, uploaded_file)
+            st.image(image_bytes, caption="Uploaded Image", use_column_width=True)
     
     with col2:
         description = st.text_area("Describe your injury or condition", 
@@ -1065,7 +1131,7 @@ elif page == "Injury Assessment":
     
     if uploaded_file is not None and description and analyze_button:
         with st.spinner("Analyzing your injury..."):
-            analysis_result = analyze_injury(image, description)
+            analysis_result = analyze_injury(image_bytes, description, mime_type)
             
             # Create a record of the assessment
             assessment = {
@@ -1075,16 +1141,11 @@ elif page == "Injury Assessment":
                 "description": description,
                 "image_filename": uploaded_file.name,
                 "assessment": analysis_result,
-                "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                "timestamp": datetime.now().strftime(TIMESTAMP_FORMAT)
             }
             
-            # Add to a new list for injury assessments if it doesn't exist
-            if 'injury_assessments' not in st.session_state:
-                st.session_state.injury_assessments = []
-            
             st.session_state.injury_assessments.append(assessment)
-            
-            # Update save_data and load_data functions to include injury assessments
+            append_injury_assessment(assessment)
             
             st.success("Analysis complete!")
             
@@ -1106,98 +1167,86 @@ elif page == "Analytics":
         st.warning("No data available for analytics. Generate some materials first.")
     else:
         # Create dataframes for analysis
-        materials_df = pd.DataFrame(st.session_state.generated_materials)
-        materials_df['date'] = pd.to_datetime(materials_df['timestamp']).dt.date
+        materials = st.session_state.generated_materials
+        condition_counts, patient_counts, time_series = build_materials_analytics(records_signature(materials), materials)
         
         # Layout
         col1, col2 = st.columns(2)
         
         # Materials by condition
         with col1:
-            condition_counts = materials_df['condition'].value_counts().reset_index()
-            condition_counts.columns = ['Condition', 'Count']
-            
             fig = px.pie(condition_counts, values='Count', names='Condition', title='Materials by Medical Condition')
             st.plotly_chart(fig, use_container_width=True)
         
         # Materials over time
         with col2:
-            time_series = materials_df.groupby('date').size().reset_index(name='count')
             fig = px.line(time_series, x='date', y='count', title='Materials Generated Over Time')
             st.plotly_chart(fig, use_container_width=True)
         
         # Materials by patient
-        patient_counts = materials_df['patient_name'].value_counts().reset_index()
-        patient_counts.columns = ['Patient', 'Count']
-        
         fig = px.bar(patient_counts, x='Patient', y='Count', title='Materials by Patient')
         st.plotly_chart(fig, use_container_width=True)
         
         # Chat interactions analysis
-        if any(st.session_state.chat_history):
+        chat_lengths = pd.Series({patient_id: len(messages) for patient_id, messages in st.session_state.chat_history.items()}, dtype=int)
+        chat_lengths = chat_lengths[chat_lengths > 0]
+        
+        if not chat_lengths.empty:
             st.subheader("Chat Interactions Analysis")
             
             # Calculate chat metrics
-            total_chats = 0
-            total_messages = 0
-            patients_with_chats = 0
+            total_messages = int(chat_lengths.sum())
+            patients_with_chats = len(chat_lengths)
+            total_chats = patients_with_chats
             
             chat_data = []
+            patients_by_id = st.session_state.patients_by_id
+            for patient_id, message_count in chat_lengths.items():
+                # Find patient name
+                patient = patients_by_id.get(patient_id)
+                patient_name = patient['name'] if patient else "Unknown"
+                
+                chat_data.append({
+                    "Patient": patient_name,
+                    "Messages": message_count,
+                    "Last Interaction": st.session_state.chat_history[patient_id][-1]["timestamp"]
+                })
             
-            for patient_id, messages in st.session_state.chat_history.items():
-                if messages:
-                    patients_with_chats += 1
-                    total_chats += 1
-                    total_messages += len(messages)
-                    
-                    # Find patient name
-                    patient_name = next((p['name'] for p in st.session_state.patient_records if p['id'] == patient_id), "Unknown")
-                    
-                    chat_data.append({
-                        "Patient": patient_name,
-                        "Messages": len(messages),
-                        "Last Interaction": messages[-1]["timestamp"] if messages else "N/A"
-                    })
-        
+            # Display chat metrics
+            col3, col4, col5 = st.columns(3)
+            with col3:
+                st.metric("Total Chat Sessions", total_chats)
+            with col4:
+                st.metric("Total Messages", total_messages)
+            with col5:
+                st.metric("Patients Using Chat", patients_with_chats)
+            
+            # Display chat data table
+            chat_df = pd.DataFrame(chat_data)
+            st.dataframe(chat_df)
 
 
-        if 'injury_assessments' in st.session_state and st.session_state.injury_assessments:
+        if st.session_state.injury_assessments:
             st.subheader("Injury Assessment Analysis")
     
             # Create dataframe for injury assessments
-            injury_df = pd.DataFrame(st.session_state.injury_assessments)
-            injury_df['date'] = pd.to_datetime(injury_df['timestamp']).dt.date
+            injury_assessments = st.session_state.injury_assessments
+            time_series = build_injury_analytics(records_signature(injury_assessments), injury_assessments)
     
             # Display injury assessment metrics
-            st.metric("Total Injury Assessments", len(injury_df))
+            st.metric("Total Injury Assessments", len(injury_assessments))
     
             # Display assessments over time
-            time_series = injury_df.groupby('date').size().reset_index(name='count')
             fig = px.line(time_series, x='date', y='count', title='Injury Assessments Over Time')
             st.plotly_chart(fig, use_container_width=True)
     
             # Display assessments table
             with st.expander("View All Injury Assessments"):
-                st.dataframe(injury_df[['patient_name', 'patient_age', 'description', 'timestamp']])
-
-
-            # Display chat metrics
-            col3, col4, col5 = st.columns(3)
-            with col3:
-                st.metric("Total Chat Sessions", total_chats)
-            with col4:
-                st.metric("Total Messages", total_messages)
-            with col5:
-                st.metric("Patients Using Chat", patients_with_chats)
-            
-            # Display chat data table
-            if chat_data:
-                chat_df = pd.DataFrame(chat_data)
-                st.dataframe(chat_df)
+                st.dataframe(pd.DataFrame(injury_assessments, columns=['patient_name', 'patient_age', 'description', 'timestamp']))
         
         # Display raw data
         with st.expander("View Raw Data"):
-            st.dataframe(materials_df)
+            st.dataframe(pd.DataFrame(materials))
 
 elif page == "Knowledge Assessment":
     st.title("📝 Knowledge Assessment")
@@ -1206,47 +1255,35 @@ elif page == "Knowledge Assessment":
         st.warning("No patients found. Please add patients first.")
     else:
         # Patient selection
-        patient_names = [f"{p['name']} - {p['condition']}" for p in st.session_state.patient_records]
-        selected_patient = st.selectbox("Select Patient", patient_names)
-        
-        # Get the selected patient's index
-        patient_index = patient_names.index(selected_patient)
-        patient = st.session_state.patient_records[patient_index]
+        patient = select_patient()
         patient_id = patient["id"]
         
         # Display patient information
-        with st.expander("Patient Information", expanded=True):
-            col1, col2 = st.columns(2)
-            
-            with col1:
-                st.markdown(f"Name: {patient['name']}")
-                st.markdown(f"Age: {patient['age']}")
-                st.markdown(f"Gender: {patient['gender']}")
-                st.markdown(f"Education Level: {patient['education_level']}")
-                st.markdown(f"Primary Language: {patient['language']}")
-            
-            with col2:
-                st.markdown(f"Medical Condition: {patient['condition']}")
-                st.markdown(f"Treatment Plan: {patient['treatment']}")
-                st.markdown(f"Medications: {patient['medications']}")
-                st.markdown(f"Learning Style: {patient['learning_style']}")
-                st.markdown(f"Special Needs: {patient['special_needs']}")
+        render_patient_info(patient, expanded=True)
         
         # Generate knowledge assessment
         if st.button("Generate Knowledge Assessment"):
-            with st.spinner("Generating personalized assessment..."):
-                assessment = generate_knowledge_assessment(patient)
+            with st.status("Generating personalized assessment...") as status:
+                questions = generate_knowledge_assessment(
+                    patient,
+                    on_question=lambda number, question: st.write(f"*Question {number}:* {question['text']}")
+                )
                 
-                if "error" in assessment:
-                    st.error("Failed to generate assessment. Please try again.")
+                # A failed generation discards any questions already shown
+                if questions is None:
+                    status.update(label="Assessment generation failed", state="error")
                 else:
-                    st.session_state.patient_assessments[patient_id] = {
-                        "assessment": assessment,
-                        "user_responses": {},
-                        "results": None
-                    }
-                    save_data()
-                    st.success("Assessment generated successfully!")
+                    status.update(label="Assessment generated", state="complete")
+            
+            if questions is None:
+                st.error("Failed to generate assessment. Please try again.")
+            else:
+                st.session_state.patient_assessments[patient_id] = {
+                    "assessment": {"questions": questions},
+                    "user_responses": {},
+                    "results": None
+                }
+                st.success("Assessment generated successfully!")
         
         # Display the assessment if it exists
         if patient_id in st.session_state.patient_assessments:
@@ -1257,21 +1294,23 @@ elif page == "Knowledge Assessment":
             
             st.markdown("### Knowledge Assessment")
             
-            # Display questions and collect user responses
-            for i, question in enumerate(assessment["questions"]):
-                st.markdown(f"*Question {i+1}:* {question['text']}")
-                options = question["options"]
-                user_responses[f"question_{i}"] = st.radio(
-                    f"Select your answer for question {i+1}:",
-                    options,
-                    key=f"question_{i}"
-                )
+            # Display questions and collect user responses; the form only reruns the script on submit
+            with st.form("assessment_form"):
+                for i, question in enumerate(assessment["questions"]):
+                    st.markdown(f"*Question {i+1}:* {question['text']}")
+                    options = question["options"]
+                    user_responses[f"question_{i}"] = st.radio(
+                        f"Select your answer for question {i+1}:",
+                        options,
+                        key=f"question_{i}"
+                    )
+                
+                submitted = st.form_submit_button("Submit Assessment")
             
             # Evaluate responses
-            if st.button("Submit Assessment"):
+            if submitted:
                 results = evaluate_responses(assessment, user_responses)
                 st.session_state.patient_assessments[patient_id]["results"] = results
-                save_data()
                 st.success("Assessment submitted!")
             
             # Display results if available
@@ -0,0 +1,54 @@
+import hashlib
+import json
+import os
+import tempfile
+
+import serialization
+
+# Directory where cached Gemini responses are stored (one JSON file per prompt)
+CACHE_DIR = ".llm_cache"
+
+
+def make_key(*parts):
+    """Builds a cache key from the prompt and any extra inputs such as image data."""
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode()
+        digest.update(hashlib.sha256(part).digest())
+    return digest.hexdigest()
+
+
+def get(key):
+    """Returns the cached response for a key, or None if it has not been stored."""
+    try:
+        with open(os.path.join(CACHE_DIR, f"{key}.json"), "rb") as f:
+            return serialization.loads(f.read())["response"]
+    except (FileNotFoundError, json.JSONDecodeError, KeyError):
+        return None
+
+
+def put(key, response):
+    """Stores a response on disk so it survives Streamlit reruns and restarts."""
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    path = os.path.join(CACHE_DIR, f"{key}.json")
+    # A unique temp file per writer, so concurrent puts of the same key can't truncate each other
+    with tempfile.NamedTemporaryFile(dir=CACHE_DIR, suffix=".tmp", delete=False) as f:
+        f.write(serialization.dumps({"response": response}))
+    os.replace(f.name, path)
+
+
+def delete(key):
+    """Removes the cached response for a key, if there is one."""
+    try:
+        os.remove(os.path.join(CACHE_DIR, f"{key}.json"))
+    except FileNotFoundError:
+        pass
+
+
+def clear():
+    """Removes every cached response."""
+    if not os.path.isdir(CACHE_DIR):
+        return
+    for filename in os.listdir(CACHE_DIR):
+        os.remove(os.path.join(CACHE_DIR, filename))
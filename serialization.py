@@ -0,0 +1,14 @@
+import json
+
+# Use orjson when it is installed, falling back to the standard library otherwise.
+# Both aliases work with bytes: dumps returns bytes and loads accepts bytes or str.
+try:
+    import orjson
+
+    dumps = orjson.dumps
+    loads = orjson.loads
+except ImportError:
+    def dumps(obj):
+        return json.dumps(obj).encode()
+
+    loads = json.loads